@@ -1,19 +1,34 @@
 import json
+import csv
 import datetime
+import itertools
 import os
 import re
 
 # INIT
 DATA_FILE = 'data.json'
+CHANGES_FILE = 'changes.jsonl' # append-only change feed, one json line per seq
 DATE_FORMAT = '%Y-%m-%d'
 TIME_FORMAT = '%H:%M'
 TIME_SLOT_PATTERN = re.compile(r'^(\d{2}:\d{2})-(\d{2}:\d{2})$') # thank you https://stackoverflow.com/questions/69806492/regex-d4-d2-d2
+ICS_DATETIME_FORMAT = '%Y%m%dT%H%M%S'
+EXPORT_FILTERS = {
+  '1': ('bookUsername', 'teacher username'),
+  '2': ('bookClass', 'class name'),
+  '3': ('roomID', 'classroom ID'),
+}
+CSV_HEADER = ['Room ID', 'Room Name', 'Date', 'Start', 'End', 'Teacher', 'Subject', 'Class', 'Remarks']
+CHANGE_LOG_LIMIT = 500 # the feed keeps this many changes, clients further behind take a full snapshot instead
+FEED_SEQ_PATTERN = re.compile(r'^\{"seq": (\d+),') # read the seq without parsing the whole line
 classrooms = [] 
 bookings = [] 
 users = []
+changeSeq = 0 # every mutation gets a seq number so clients can sync just the deltas
+pendingChanges = [] # written to the feed by save_data, after data.json
+feedLength = 0
 currentUser = None
 def load_data():
-  global classrooms, bookings, users
+  global classrooms, bookings, users, changeSeq
 
   if os.path.exists(DATA_FILE):
     with open(DATA_FILE, 'r') as f:
@@ -21,11 +36,16 @@ def load_data():
       classrooms = data.get('classrooms', [])
       bookings = data.get('bookings', [])
       users = data.get('users', [])
+      changeSeq = data.get('changeSeq', 0)
+    _load_change_feed()
     print(f"Data loaded from {DATA_FILE}")
 
   else:
     # Initialize some default stuff if no file exists
     print(f"No data file found ({DATA_FILE}). Starting with empty data.")
+    # old changes belong to the old data, start a new feed so clients take a snapshot
+    changeSeq = 0
+    _write_change_feed([])
     classrooms.extend([
       {"roomID": "C01", "roomName": "Classroom 1A", "roomCapacity": 35},
       {"roomID": "C02", "roomName": "Classroom 1B", "roomCapacity": 35},
@@ -64,10 +84,93 @@ def save_data():
     'classrooms': classrooms,
     'bookings': bookings,
     'users': users,
+    'changeSeq': changeSeq,
   }
   with open(DATA_FILE, 'w') as f:
     json.dump(data, f, indent=2)
   print(f"Data saved to {DATA_FILE}")
+  _flush_changes()
+
+# CHANGE FEED
+def get_changes_since(seq):
+  # returns the changes after seq, or None if the client has to take get_snapshot() instead
+  if seq == changeSeq:
+    return []
+  if seq < 0 or seq > changeSeq: # ahead of us means our data was reset
+    return None
+  if changeSeq - seq > CHANGE_LOG_LIMIT: # too far behind, snapshot is cheaper
+    return None
+  result = []
+  for lineSeq, line in _iter_change_feed():
+    if lineSeq <= seq:
+      continue # skipped lines are never parsed
+    if lineSeq != seq + len(result) + 1:
+      return None # gap in the feed (eg crash before it was written), cant give complete deltas
+    result.append(json.loads(line))
+  if seq + len(result) != changeSeq:
+    return None # feed doesnt reach changeSeq
+  return result
+
+def get_snapshot():
+  # copies, so later bookings dont change a snapshot the client already has
+  return {
+    'seq': changeSeq,
+    'classrooms': [dict(c) for c in classrooms],
+    'bookings': [dict(b) for b in bookings],
+    'users': [dict(u) for u in users],
+  }
+
+def _record_change(entity, action, record):
+  # entity is 'classroom', 'booking' or 'user', action is 'add', 'update' or 'remove'
+  global changeSeq
+  changeSeq += 1
+  pendingChanges.append({
+    "seq": changeSeq,
+    "entity": entity,
+    "action": action,
+    "data": dict(record), # copy, it is only written on the next save
+  })
+
+def _flush_changes():
+  # called after data.json is saved, so the feed never has changes the data doesnt
+  global feedLength
+  if not pendingChanges:
+    return
+  with open(CHANGES_FILE, 'a', encoding='utf-8', newline='\n') as f:
+    for change in pendingChanges:
+      f.write(json.dumps(change, ensure_ascii=False) + '\n')
+  feedLength += len(pendingChanges)
+  pendingChanges.clear()
+  if feedLength > 2 * CHANGE_LOG_LIMIT: # trim now and then, not on every save
+    _write_change_feed([line for lineSeq, line in _iter_change_feed()][-CHANGE_LOG_LIMIT:])
+
+def _load_change_feed():
+  # drops a half written last line, anything newer than data.json and anything past the limit
+  global feedLength
+  lines = [line for lineSeq, line in _iter_change_feed() if lineSeq <= changeSeq][-CHANGE_LOG_LIMIT:]
+  feedLength = len(lines)
+  fileSize = os.path.getsize(CHANGES_FILE) if os.path.exists(CHANGES_FILE) else 0
+  if sum(len(line.encode('utf-8')) for line in lines) != fileSize: # something was dropped
+    _write_change_feed(lines)
+
+def _iter_change_feed():
+  # yields (seq, line) for every complete line, a line without its newline was cut off by a crash
+  if not os.path.exists(CHANGES_FILE):
+    return
+  with open(CHANGES_FILE, 'r', encoding='utf-8', errors='replace') as f: # a cut off line can end mid character
+    for line in f:
+      match = FEED_SEQ_PATTERN.match(line)
+      if not match or not line.endswith('\n'):
+        break
+      yield int(match.group(1)), line
+
+def _write_change_feed(lines):
+  global feedLength
+  # write a temp file first so a crash here cant lose the old feed
+  with open(CHANGES_FILE + '.tmp', 'w', encoding='utf-8', newline='\n') as f:
+    f.writelines(lines)
+  os.replace(CHANGES_FILE + '.tmp', CHANGES_FILE)
+  feedLength = len(lines)
 
 # MAIN
 def login():
@@ -98,7 +201,8 @@ def teacher_menu():
     print("  2. Show Bookings")              
     print("  3. Book Classroom")              
     print("  4. Cancel Booking")              
-    print("  5. Exit")
+    print("  5. Export Schedule")
+    print("  6. Exit")
     print("==============================")
 
     choice = input("Enter your choice: ").strip()
@@ -112,6 +216,8 @@ def teacher_menu():
     elif choice == '4':
       cancel_booking()
     elif choice == '5':
+      export_schedule()
+    elif choice == '6':
       print("Exiting CWY Booking System. Goodbye!")
       break
     else:
@@ -127,7 +233,8 @@ def admin_menu():
     print("  3. Book Classroom")              
     print("  4. Cancel Booking")              
     print("  5. Edit Classrooms")                 
-    print("  6. Exit")
+    print("  6. Export Schedule")
+    print("  7. Exit")
     print("==============================")
 
     choice = input("Enter your choice: ").strip()
@@ -143,6 +250,8 @@ def admin_menu():
     elif choice == '5':
       edit_classrooms()
     elif choice == '6':
+      export_schedule()
+    elif choice == '7':
       print("Exiting CWY Admin Menu. Goodbye!")
       break
     else:
@@ -221,6 +330,7 @@ def book_classroom():
       current_date += datetime.timedelta(days=7)
     weekday = datetime.datetime.strptime(startDate, DATE_FORMAT).strftime('%A')
     print(f"Recurring booking dates: ({weekday}) {', '.join(bookDates)}")
+    bookSeries = f"{roomID}-{startDate}-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}" # links the weekly bookings together for export
   else:
     print("You are booking a single date.")
     bookDate = _get_valid_date_input()
@@ -249,9 +359,11 @@ def book_classroom():
           "bookTeacher": bookTeacher,
           "bookSubject": bookSubject,
           "bookClass": bookClass, # Add class name to booking
-          "bookRemarks": bookRemarks
+          "bookRemarks": bookRemarks,
+          "bookSeries": bookSeries
         }
         bookings.append(new_booking)
+        _record_change('booking', 'add', new_booking)
         print(f"Successfully booked {roomID} for {bookDate} at {bookTime}.")
       else:
         print(f"Error: {roomID} is already booked for {bookDate} during {bookTime} (overlap detected).")
@@ -270,6 +382,7 @@ def book_classroom():
         "bookRemarks": bookRemarks
       }
       bookings.append(new_booking)
+      _record_change('booking', 'add', new_booking)
       save_data()
       print(f"\nSuccessfully booked {roomID} for {bookDate} at {bookTime}.")
     else:
@@ -366,6 +479,7 @@ def cancel_booking():
       # Only allow if admin or teacher is the booker
       if currentUser['role'] == 'admin' or (currentUser['role'] == 'teacher' and canceled_booking['bookUsername'].lower() == currentUser['username'].lower()):
         bookings.pop(booking_index)
+        _record_change('booking', 'remove', canceled_booking)
         save_data()
         roomName = _get_classroom_by_id(canceled_booking['roomID'])['roomName']
         print(f"\nBooking for {roomName} on {canceled_booking['bookDate']} {canceled_booking['bookTime']} by {canceled_booking['bookTeacher']} has been cancelled.")
@@ -378,6 +492,155 @@ def cancel_booking():
 
 
 
+def export_schedule():
+  print("\n--- Export Schedule ---")
+  print("  1. By Teacher (username)")
+  print("  2. By Class")
+  print("  3. By Classroom")
+  choice = input("Export whose schedule? ").strip()
+  if choice not in EXPORT_FILTERS:
+    print("Invalid choice.")
+    return
+  field, label = EXPORT_FILTERS[choice]
+  value = input(f"Enter {label}: ").strip()
+  if not value:
+    print(f"{label.capitalize()} cannot be empty.")
+    return
+
+  matching = _iter_matching_bookings(field, value)
+  first = next(matching, None) # peek so a typo doesnt write an empty file
+  if first is None:
+    print(f"No bookings found for {label} {value}.")
+    return
+  matching = itertools.chain([first], matching)
+
+  fileFormat = input("Export as iCalendar or CSV? (ics/csv): ").strip().lower()
+  if fileFormat not in ['ics', 'csv']:
+    print("Invalid format. Please enter ics or csv.")
+    return
+  fileName = input(f"Enter file name (default: schedule.{fileFormat}): ").strip() or f"schedule.{fileFormat}"
+  if os.path.abspath(fileName) in [os.path.abspath(p) for p in (DATA_FILE, CHANGES_FILE, __file__)]:
+    print(f"Error: Cannot export to {fileName}, it is used by the booking system.")
+    return
+  if os.path.exists(fileName):
+    confirm = input(f"{fileName} already exists. Overwrite? (y/n): ").strip().lower()
+    if confirm != 'yes' and confirm != 'y':
+      print("Export cancelled.")
+      return
+
+  try:
+    # newline='' so csv/ics keep their own CRLF line endings
+    with open(fileName, 'w', encoding='utf-8', newline='') as f:
+      if fileFormat == 'ics':
+        f.writelines(_iter_ics_lines(matching))
+      else:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        writer.writerows(_iter_csv_rows(matching))
+  except OSError as e:
+    print(f"Error: Could not write {fileName} ({e}).")
+    return
+  print(f"Schedule for {label} {value} exported to {fileName}")
+
+# everything below is generators so exporting never builds the whole file in memory
+def _iter_matching_bookings(field, value):
+  value = value.lower()
+  for booking in bookings:
+    if booking.get(field, '').lower() == value:
+      yield booking
+
+def _iter_csv_rows(matching):
+  for booking in matching:
+    start, end = TIME_SLOT_PATTERN.match(booking['bookTime']).groups()
+    room = _get_classroom_by_id(booking['roomID'])
+    yield [
+      booking['roomID'],
+      room['roomName'] if room else '',
+      booking['bookDate'],
+      start,
+      end,
+      booking['bookTeacher'],
+      booking['bookSubject'],
+      booking['bookClass'],
+      booking.get('bookRemarks', ''),
+    ]
+
+def _iter_ics_events(matching):
+  # book_classroom appends a weekly series in one go, so its bookings sit next to each other
+  # and we only ever hold the dates of the series we are in (at most a year of weeks)
+  for seriesID, group in itertools.groupby(matching, key=lambda b: b.get('bookSeries')):
+    if seriesID is None:
+      for booking in group:
+        yield booking, None
+    else:
+      first = next(group)
+      dates = sorted({first['bookDate']} | {b['bookDate'] for b in group})
+      yield first, dates
+
+def _iter_ics_lines(matching):
+  stamp = datetime.datetime.now(datetime.timezone.utc).strftime(ICS_DATETIME_FORMAT) + 'Z'
+  yield 'BEGIN:VCALENDAR\r\n'
+  yield 'VERSION:2.0\r\n'
+  yield 'PRODID:-//CWY//Booking System//EN\r\n'
+  for booking, dates in _iter_ics_events(matching):
+    if dates is None:
+      dates = [booking['bookDate']]
+      uid = f"{booking['roomID']}-{booking['bookDate']}-{booking['bookTime']}@cwy"
+    else:
+      uid = f"{booking['bookSeries']}-{dates[0]}@cwy" # first date too, in case a series got split up
+    start, end = TIME_SLOT_PATTERN.match(booking['bookTime']).groups()
+    room = _get_classroom_by_id(booking['roomID'])
+    lines = [
+      'BEGIN:VEVENT',
+      f"UID:{uid}",
+      f"DTSTAMP:{stamp}",
+      f"DTSTART:{_to_ics_datetime(dates[0], start)}",
+      f"DTEND:{_to_ics_datetime(dates[0], end)}",
+    ]
+    if len(dates) > 1:
+      lines.append(f"RRULE:FREQ=WEEKLY;UNTIL={_to_ics_datetime(dates[-1], start)}")
+      # weeks that were skipped (overlap) or cancelled since
+      exdates = []
+      current_date = datetime.datetime.strptime(dates[0], DATE_FORMAT).date()
+      end_date = datetime.datetime.strptime(dates[-1], DATE_FORMAT).date()
+      booked = set(dates)
+      while current_date < end_date:
+        if current_date.strftime(DATE_FORMAT) not in booked:
+          exdates.append(_to_ics_datetime(current_date.strftime(DATE_FORMAT), start))
+        current_date += datetime.timedelta(days=7)
+      if exdates:
+        lines.append(f"EXDATE:{','.join(exdates)}")
+    lines.extend([
+      f"SUMMARY:{_ics_escape(booking['bookSubject'] + ' (' + booking['bookClass'] + ')')}",
+      f"LOCATION:{_ics_escape(room['roomName'] if room else booking['roomID'])}",
+      f"DESCRIPTION:{_ics_escape('Booked by ' + booking['bookTeacher'] + '. ' + booking.get('bookRemarks', ''))}",
+      'END:VEVENT',
+    ])
+    for line in lines:
+      yield _ics_fold(line)
+  yield 'END:VCALENDAR\r\n'
+
+def _to_ics_datetime(date_str, time_str):
+  # both are already validated, so just reformat the text (strptime is slow when exporting a whole year)
+  return f"{date_str.replace('-', '')}T{time_str.replace(':', '')}00"
+
+def _ics_escape(text):
+  return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _ics_fold(line):
+  # iCalendar lines must be at most 75 bytes, longer ones continue on the next line after a space
+  if len(line.encode('utf-8')) <= 75:
+    return line + '\r\n'
+  out = ''
+  size = 0
+  for char in line:
+    charSize = len(char.encode('utf-8'))
+    if size + charSize > 75:
+      out += '\r\n '
+      size = 1
+    out += char
+    size += charSize
+  return out + '\r\n'
 
 
 